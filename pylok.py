@@ -1,7 +1,46 @@
+import contextlib
+import datetime
 import errno
+import json
 import os
+import stat
+import threading
+import time
+import uuid
 import yaml
 from enum import Enum
+from types import MappingProxyType
+
+try:
+    # Prefer the libyaml C binding when available
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+def _json_default(value):
+    # yaml stored dates natively, json has no type for them so they are written as iso strings
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# Shared encoder, json.dumps would build a new one per call since separators are not the default
+_encoder = json.JSONEncoder(separators=(',', ':'), default=_json_default)
+
+# Seconds is_locked may reuse an earlier answer for the same lock file, 0 disables the cache.
+# Locks taken or removed by other processes are not seen until the cached answer expires.
+STATUS_CACHE_TTL = 0
+_STATUS_CACHE_SIZE = 1024
+_status_cache = {}
+# Guards the LRU reorder and eviction, single pops are atomic on their own
+_status_cache_lock = threading.Lock()
+
+# errnos os.link raises on filesystems without hard link support
+_NO_HARD_LINK_ERRNOS = {errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV}
+
+# Lock directories already created by this process, so lock() skips the mkdir afterwards.
+# Bounded by starting over when full, which only costs one more mkdir per directory.
+_ENSURED_DIRS_SIZE = 1024
+_ensured_dirs = set()
 
 class LockAction(Enum):
     UNLOCK = 'unlock'
@@ -9,66 +48,51 @@ class LockAction(Enum):
     STATUS= 'status'
 
 
-class LockFileNotPresentError(Exception):
-    def __init__(self, *args, **kwargs):
-        default_message = 'Lock file expected BUT NOT present. Please verify status of Lock file'
-
-        if not (args or kwargs): args = (default_message,)
-
-        # Call super constructor
-        super(LockFileNotPresentError, self).__init__(*args, **kwargs)
+class PylokError(Exception):
+    default_message = ''
 
-class LockFilePresentError(Exception):
     def __init__(self, *args, **kwargs):
-        default_message = 'Lock file already present. Please verify status of Lock file'
-
-        if not (args or kwargs): args = (default_message,)
+        if not (args or kwargs): args = (self.default_message,)
 
         # Call super constructor
-        super(LockFilePresentError, self).__init__(*args, **kwargs)
-
+        super(PylokError, self).__init__(*args, **kwargs)
 
-class LockFileNotPresentForRemoval(Exception):
-    def __init__(self, *args, **kwargs):
-        default_message = 'Attempted to remove lock file, but lock file not found.'
+class LockFileNotPresentError(PylokError):
+    default_message = 'Lock file expected BUT NOT present. Please verify status of Lock file'
 
-        if not (args or kwargs): args = (default_message,)
+class LockFilePresentError(PylokError):
+    default_message = 'Lock file already present. Please verify status of Lock file'
 
-        super(LockFileNotPresentForRemoval, self).__init__(*args, **kwargs)
 
-class LockActionError(Exception):
-    def __init__(self, *args, **kwargs):
-        default_message = 'Lock Action not actionable.'
+class LockFileNotPresentForRemoval(LockFileNotPresentError):
+    default_message = 'Attempted to remove lock file, but lock file not found.'
 
-        if not (args or kwargs): args = (default_message,)
+class LockActionError(PylokError):
+    default_message = 'Lock Action not actionable.'
 
-        # Call super constructor
-        super(LockActionError, self).__init__(*args, **kwargs)
+class LockObjectError(PylokError):
+    default_message = 'Lock object must be a plain name, without path separators.'
 
-def ensure_lock(lock_file):
+def ensure_lock(lock_file, lock_ttl=None):
     # ensure a lock file exists or don't proceed
-    file_is_locked = is_locked(lock_file)
+    file_is_locked = is_locked(lock_file, lock_ttl=lock_ttl)
     if not file_is_locked:
         raise LockFileNotPresentError()
     return True
 
-def ensure_unlock(lock_file):
+def ensure_unlock(lock_file, lock_ttl=None):
     # ensure a lock file does not exist, or don't proceedz 
-    file_is_locked = is_locked(lock_file)
+    file_is_locked = is_locked(lock_file, lock_ttl=lock_ttl)
     if file_is_locked:
         raise LockFilePresentError()
     return True
 
 def create_lock_dir(lock_file_directory):
     # Make the directory
-    try:
-        os.makedirs(lock_file_directory)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
+    os.makedirs(lock_file_directory, exist_ok=True)
 
 
-def lock(lock_file_directory, lock_object, lock_data={}, lock_action='status', ensure_unlock_state=False, ensure_lock_state=False, ):
+def lock(lock_file_directory, lock_object, lock_data=None, lock_action='status', ensure_unlock_state=False, ensure_lock_state=False, lock_ttl=None, ):
     """
     Manipulates lock files with the option to add data to the lock file.
 
@@ -80,14 +104,15 @@ def lock(lock_file_directory, lock_object, lock_data={}, lock_action='status', e
 
     Parameters:
         lock_file_directory (str): directory to store lock in. # sanatize later
-        lock_object (str) : name of object to lock, will need to be consistent for each check. Creates lock file of 'lock_obj.lock'
-        lock_data (dict): Data to be written to lock_file in yaml, when lock_action == lock, also return data
-        lock_action (enum) (default:'status'):  ['status', 'lock', 'unlock'] action to perform 
+        lock_object (str) : name of object to lock, will need to be consistent for each check. Creates lock file of 'lock_obj.lock'. Raises LockObjectError if it contains a path separator
+        lock_data (dict): Data to be written to lock_file in json, when lock_action == lock, also return data. datetime/date values are stored as iso strings
+        lock_action (enum) (default:'status'):  ['status', 'lock', 'unlock'] or LockAction member, action to perform 
         ensure_unlock (bool): default: False | Checks for lock file, raises exception if file lock present
         ensure_lock (bool): default: False | Checks for lock file, raises exception if file lock not present
+        lock_ttl (float): default: None | Seconds a lock is held since it was last written or refreshed, expired locks are treated as unlocked and removed
 
     Returns:
-        Dictionary with data written to lock file as well as the initial lock_data.
+        Dictionary with data written to lock file as well as the initial lock_data. lock_data itself is not modified.
     
     Note:
         
@@ -125,7 +150,8 @@ def lock(lock_file_directory, lock_object, lock_data={}, lock_action='status', e
             'lock_action': 'lock'
         }
 
-        # Expire could be controlled by a external audit/state scraper that deletes the lock at expire time.
+        # Expire could be controlled by a external audit/state scraper that deletes the lock at expire time,
+        # or by passing lock_ttl, which removes the lock the next time it is checked after expiring.
 
         # Update lock action
         data_to_lock.update({'lock_action': 'status'})
@@ -156,111 +182,294 @@ def lock(lock_file_directory, lock_object, lock_data={}, lock_action='status', e
     # if --ensure-lock-first is enabled, we will not run command unless lock file found.
     # if --ensure-unlock-first is enabled we will not run command unless lock file is nonexistant
     
+    # Work on a copy, the caller's dict (or a shared default) is never mutated
+    lock_data = dict(lock_data) if lock_data else {}
+
     # Lock info
-    lock_file_name = "{}.lock".format(lock_object)
-    lock_file = "{}{}".format(lock_file_directory, lock_file_name)
+    lock_file = _lock_file_path(lock_file_directory, lock_object)
 
-    create_lock_dir(lock_file_directory)
+    # Accept either a LockAction or its value, normalized once so the handler is a single lookup
+    try:
+        action = lock_action if isinstance(lock_action, LockAction) else LockAction(lock_action)
+    except ValueError as e:
+        raise LockActionError() from e
 
-        # Ignore lock functions on ignore
-    if lock_action == LockAction.STATUS.value:
+    if lock_file_directory not in _ensured_dirs:
+        create_lock_dir(lock_file_directory)
+        if len(_ensured_dirs) >= _ENSURED_DIRS_SIZE:
+            _ensured_dirs.clear()
+        _ensured_dirs.add(lock_file_directory)
 
-        file_is_locked = is_locked(lock_file)
+    _ACTIONS[action](lock_file_directory, lock_file, lock_data, ensure_unlock_state=ensure_unlock_state,
+                     ensure_lock_state=ensure_lock_state, lock_ttl=lock_ttl)
 
-        if file_is_locked is False:
-            lock_file = None
-            current_lock_status = 'unlocked'
-        else:
-            current_lock_status = 'locked'
-            # Update lock data with current contents of lock file.
-            y = yaml.load(open(lock_file))
-            if y:
-                lock_data.update(y)
+    #print(lock_action)
+
+    lock_data.update({'lock_action': action.value})
+    return lock_data
 
-        return_info = {
-            'lock_file_location': lock_file,
-            'lock_file_status': current_lock_status,
-        }
 
-        lock_data.update(return_info)
+def _lock_file_path(lock_file_directory, lock_object):
+    # os.path.join would drop the directory for an absolute lock_object, keep every lock inside it
+    lock_file_name = f"{lock_object}.lock"
+    if os.sep in lock_file_name or (os.altsep and os.altsep in lock_file_name):
+        raise LockObjectError()
+    return os.path.join(lock_file_directory, lock_file_name)
 
-    elif lock_action == LockAction.UNLOCK.value:
-        if ensure_lock_state:
-            ensure_lock(lock_file)
+def _lock_status(lock_file_directory, lock_file, lock_data, ensure_unlock_state=False, ensure_lock_state=False, lock_ttl=None):
+    file_is_locked = is_locked(lock_file, lock_ttl=lock_ttl)
 
+    y = None
+    if file_is_locked:
+        # Update lock data with current contents of lock file.
         try:
-            remove_lock_file(lock_file)
-        except:
-            raise LockFileNotPresentError()
+            y = read_lock_file(lock_file)
+        except (FileNotFoundError, IsADirectoryError):
+            # Removed (or replaced) since it was checked or since a cached answer, so it is unlocked
+            _status_cache.pop(lock_file, None)
+            file_is_locked = False
+
+    if file_is_locked is False:
+        lock_file = None
+        current_lock_status = 'unlocked'
+    else:
+        current_lock_status = 'locked'
+        if y:
+            lock_data.update(y)
 
-        # Verify
-        file_is_locked = is_locked(lock_file)
+    return_info = {
+        'lock_file_location': lock_file,
+        'lock_file_status': current_lock_status,
+    }
 
-        if file_is_locked is False:
-            current_lock_status = 'unlocked'
-            lock_file = None
+    lock_data.update(return_info)
 
-        else:
-            raise LockFileNotPresentForRemoval()
+def _lock_unlock(lock_file_directory, lock_file, lock_data, ensure_unlock_state=False, ensure_lock_state=False, lock_ttl=None):
+    # A missing lock file already fails the unlink, only an expired one needs checking first
+    if ensure_lock_state and lock_ttl is not None:
+        ensure_lock(lock_file, lock_ttl=lock_ttl)
 
-        return_info = {
-            'lock_file_location': lock_file,
-            'lock_file_status': current_lock_status,
-        }
+    try:
+        remove_lock_file(lock_file)
+    except FileNotFoundError as e:
+        raise LockFileNotPresentForRemoval() from e
 
-        lock_data.update(return_info)
+    # The unlink succeeding is the verification, no second probe on the unlock path
+    current_lock_status = 'unlocked'
+    lock_file = None
 
-    elif lock_action == LockAction.LOCK.value:
-        if ensure_unlock_state:
-            ensure_unlock(lock_file)
-            current_lock_status = 'unlocked'
+    return_info = {
+        'lock_file_location': lock_file,
+        'lock_file_status': current_lock_status,
+    }
 
-        create_lock_file(lock_file)
-        current_lock_status = 'locked'
+    lock_data.update(return_info)
 
-        return_info = {
-            'lock_file_location': lock_file,
-            'lock_file_status': current_lock_status,
-        }
+def _lock_lock(lock_file_directory, lock_file, lock_data, ensure_unlock_state=False, ensure_lock_state=False, lock_ttl=None):
+    current_lock_status = 'locked'
 
-        lock_data.update(return_info)
+    return_info = {
+        'lock_file_location': lock_file,
+        'lock_file_status': current_lock_status,
+    }
 
-        write_to_lock_file(location=lock_file_directory, lock_object=lock_object, lock_data=lock_data)
-        
-        # Verify
-        file_is_locked = is_locked(lock_file)
+    lock_data.update(return_info)
 
-        if file_is_locked is True:
-            current_lock_status = 'locked' 
-            locked_file = lock_file
-        else:
-            raise LockFileNotPresentError()
+    if ensure_unlock_state and lock_ttl is not None:
+        # Clear out an expired lock so the exclusive create below can take it
+        is_locked(lock_file, lock_ttl=lock_ttl)
 
-    else:
-        raise LockActionError()
+    # Create and write in one open, ensure_unlock_state is checked atomically by the create itself
+    try:
+        write_to_lock_file(lock_file, lock_data=lock_data, exclusive=ensure_unlock_state)
+    except FileNotFoundError:
+        # The lock directory was removed after it was first created
+        create_lock_dir(lock_file_directory)
+        write_to_lock_file(lock_file, lock_data=lock_data, exclusive=ensure_unlock_state)
 
-    #print(lock_action)
+# Handler for each LockAction, built once at import
+_ACTIONS = MappingProxyType({
+    LockAction.STATUS: _lock_status,
+    LockAction.UNLOCK: _lock_unlock,
+    LockAction.LOCK: _lock_lock,
+})
 
-    lock_data.update({'lock_action': lock_action})
-    return lock_data
 
+def lock_many(lock_file_directory, lock_objects, lock_data=None, lock_action='lock', ensure_unlock_state=False, ensure_lock_state=False, lock_ttl=None, ):
+    """
+    Performs the same lock action on many objects in one directory.
+
+    Parameters:
+        lock_file_directory (str): directory to store locks in.
+        lock_objects (list): names of objects to lock, each creates its own 'lock_obj.lock'
+        lock_data (dict): Data to be written to every lock_file
+        lock_action (enum) (default:'lock'):  ['status', 'lock', 'unlock'] or LockAction member, action to perform
+        ensure_unlock (bool): default: False | Checks for lock file, raises exception if file lock present
+        ensure_lock (bool): default: False | Checks for lock file, raises exception if file lock not present
+        lock_ttl (float): default: None | Seconds a lock is held since it was last written or refreshed
+
+    Returns:
+        Dictionary of lock_object to the lock data returned by lock() for that object.
+
+    Note:
+        If an object fails, the exception is re-raised with a lock_results attribute holding the results
+        for the objects done before it. Only a lock with ensure_unlock_state=True is rolled back: the
+        exclusive create proves those lock files were made by this call, so they are unlocked again
+        (their lock_results show them unlocked). Without it a lock may have overwritten a lock file that
+        already belonged to someone else, so nothing is removed and lock_results tells the caller which
+        objects were locked. Other actions are never undone.
+    """
+
+    results = {}
+    try:
+        for lock_object in lock_objects:
+            results[lock_object] = lock(lock_file_directory, lock_object, lock_data=lock_data, lock_action=lock_action,
+                                        ensure_unlock_state=ensure_unlock_state, ensure_lock_state=ensure_lock_state,
+                                        lock_ttl=lock_ttl)
+    except Exception as e:
+        # Only exclusive creates prove a lock file is ours to remove
+        rollback = ensure_unlock_state and lock_action in (LockAction.LOCK, LockAction.LOCK.value)
+        for lock_object, lock_result in results.items():
+            if rollback and lock_result['lock_file_status'] == 'locked':
+                try:
+                    remove_lock_file(lock_result['lock_file_location'])
+                except FileNotFoundError:
+                    pass
+                lock_result.update({'lock_file_location': None, 'lock_file_status': 'unlocked'})
+        e.lock_results = results
+        raise
+
+    return results
+
+
+def create_lock_file(lock_file, exclusive=False, payload=None):
+    # With exclusive, O_EXCL fails if the lock file already exists, so no separate check is needed
+    flags = os.O_CREAT | os.O_WRONLY
+    if payload is not None:
+        flags |= os.O_TRUNC
+    if exclusive:
+        flags |= os.O_EXCL
+
+    _status_cache.pop(lock_file, None)
+    try:
+        fd = os.open(lock_file, flags, 0o644)
+    except FileExistsError as e:
+        raise LockFilePresentError() from e
 
-def create_lock_file(lock_file):
-    open(lock_file, 'a').close()
+    try:
+        # os.write may write less than asked, keep going until the whole payload is out
+        remaining = memoryview(payload or b'')
+        while remaining:
+            remaining = remaining[os.write(fd, remaining):]
+    except BaseException:
+        os.close(fd)
+        if exclusive:
+            # Don't leave behind an empty or partial lock that nobody holds
+            remove_lock_file(lock_file)
+        raise
+    os.close(fd)
 
-def write_to_lock_file(location=None, lock_object=None, lock_data={}):
-    lock_file = "{}{}.lock".format(location, lock_object)
-    with open(lock_file, 'w') as locker:
-        yaml.dump(lock_data, locker)
+def write_to_lock_file(lock_file, lock_data=None, exclusive=False):
+    lock_data = {} if lock_data is None else lock_data
+    payload = _encoder.encode(lock_data).encode()
+    create_lock_file(lock_file, exclusive=exclusive, payload=payload)
 
-def is_locked(lock_file):
+def read_lock_file(lock_file):
+    with open(lock_file, 'r') as locker:
+        contents = locker.read()
+    try:
+        return json.loads(contents)
+    except ValueError:
+        # Lock files written by older versions of pylok are yaml
+        return yaml.load(contents, Loader=_Loader)
+
+def is_locked(lock_file, lock_ttl=None):
+    # a single stat, no file descriptor is opened. Only a file (or a symlink to one) is a lock,
+    # a directory or a dangling symlink with the lock file's name is not
+    if lock_ttl is None:
+        if STATUS_CACHE_TTL:
+            return _cached_isfile(lock_file)
+        return os.path.isfile(lock_file)
 
     try:
-        file = open(lock_file, 'r')
+        lock_stat = os.lstat(lock_file)
+    except FileNotFoundError:
+        return False
+
+    # Expiry is judged on the lock file itself, so with a ttl only a regular file is a lock
+    if not stat.S_ISREG(lock_stat.st_mode):
+        return False
+
+    if lock_stat.st_mtime + lock_ttl > time.time():
+        return True
+
+    # Expired, remove it on the spot so no separate sweeper is needed
+    return not _break_expired_lock(lock_file, lock_stat)
+
+def _break_expired_lock(lock_file, lock_stat):
+    # Move the lock aside first, so only the exact file judged expired is ever unlinked.
+    # Returns False if the lock turned out to be held after all.
+    # A process dying between the rename and the remove leaves a '<lock_file>.<hex>.expired'
+    # tombstone behind. Tombstones are never locks, so they are safe to delete by hand or by a sweeper.
+    tombstone = f"{lock_file}.{uuid.uuid4().hex}.expired"
+    _status_cache.pop(lock_file, None)
+    try:
+        os.rename(lock_file, tombstone)
+    except FileNotFoundError:
+        # Someone else already broke it
+        return True
+
+    tombstone_stat = os.lstat(tombstone)
+    if (tombstone_stat.st_ino, tombstone_stat.st_mtime) == (lock_stat.st_ino, lock_stat.st_mtime):
+        os.remove(tombstone)
         return True
-    except:
-        return False  
+
+    # Another process broke and re-took (or refreshed) the lock in between, put it back
+    try:
+        os.link(tombstone, lock_file)
+    except FileExistsError:
+        # A newer lock was created meanwhile, either way the lock is held
+        pass
+    except OSError as e:
+        if e.errno not in _NO_HARD_LINK_ERRNOS:
+            raise
+        # No hard links on this filesystem, recreate it exclusively so a newer lock is never replaced
+        with open(tombstone, 'rb') as locker:
+            payload = locker.read()
+        with contextlib.suppress(LockFilePresentError):
+            create_lock_file(lock_file, exclusive=True, payload=payload)
+    os.remove(tombstone)
+    return False
+
+def _cached_isfile(lock_file):
+    now = time.monotonic()
+    with _status_cache_lock:
+        cached = _status_cache.pop(lock_file, None)
+        if cached is not None and now < cached[0]:
+            _status_cache[lock_file] = cached
+            return cached[1]
+
+    file_is_locked = os.path.isfile(lock_file)
+
+    with _status_cache_lock:
+        # Bounded, drop the least recently used entry
+        if len(_status_cache) >= _STATUS_CACHE_SIZE:
+            del _status_cache[next(iter(_status_cache))]
+        _status_cache[lock_file] = (now + STATUS_CACHE_TTL, file_is_locked)
+    return file_is_locked
+
+def refresh_lock(lock_file_directory, lock_object, lock_ttl=None):
+    # Restart a lock's ttl without rewriting its data, a lock that already expired can not be refreshed
+    lock_file = _lock_file_path(lock_file_directory, lock_object)
+    if lock_ttl is not None and not is_locked(lock_file, lock_ttl=lock_ttl):
+        raise LockFileNotPresentError()
+
+    try:
+        os.utime(lock_file)
+    except FileNotFoundError as e:
+        raise LockFileNotPresentError() from e
 
 def remove_lock_file(lock_file):
 
+    _status_cache.pop(lock_file, None)
     os.remove(lock_file)
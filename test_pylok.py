@@ -0,0 +1,454 @@
+import datetime
+import errno
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import pylok
+
+
+class LockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir)
+
+    def lock_file(self, lock_object):
+        return os.path.join(self.lock_dir, f"{lock_object}.lock")
+
+    def age_lock(self, lock_object, seconds):
+        # Push the lock's mtime into the past instead of sleeping
+        past = time.time() - seconds
+        os.utime(self.lock_file(lock_object), (past, past))
+
+
+
+class TestLockDir(LockTestCase):
+    def test_lock_dir_is_created(self):
+        lock_dir = os.path.join(self.lock_dir, 'a', 'b')
+
+        pylok.lock(lock_dir, 'obj', lock_action='lock')
+        self.assertTrue(os.path.isfile(os.path.join(lock_dir, 'obj.lock')))
+
+    def test_lock_dir_removed_after_first_lock_is_recreated(self):
+        lock_dir = os.path.join(self.lock_dir, 'locks')
+        pylok.lock(lock_dir, 'a', lock_action='lock')
+        self.assertIn(lock_dir, pylok._ensured_dirs)
+        shutil.rmtree(lock_dir)
+
+        result = pylok.lock(lock_dir, 'b', lock_action='lock')
+        self.assertEqual(result['lock_file_status'], 'locked')
+        self.assertEqual(os.listdir(lock_dir), ['b.lock'])
+
+    def test_ensured_dirs_are_bounded(self):
+        with mock.patch.object(pylok, '_ENSURED_DIRS_SIZE', 2), \
+                mock.patch.object(pylok, '_ensured_dirs', set()):
+            for i in range(5):
+                pylok.lock(os.path.join(self.lock_dir, str(i)), 'obj', lock_action='lock')
+            self.assertLessEqual(len(pylok._ensured_dirs), 2)
+
+
+class TestLockActions(LockTestCase):
+    def test_status_of_missing_lock(self):
+        result = pylok.lock(self.lock_dir, 'obj', lock_data={'msg': 'x'}, lock_action='status')
+
+        self.assertEqual(result, {
+            'msg': 'x',
+            'lock_file_location': None,
+            'lock_file_status': 'unlocked',
+            'lock_action': 'status',
+        })
+
+    def test_lock_status_unlock_round_trip(self):
+        locked = pylok.lock(self.lock_dir, 'obj', lock_data={'msg': 'x'}, lock_action='lock')
+        self.assertEqual(locked, {
+            'msg': 'x',
+            'lock_file_location': self.lock_file('obj'),
+            'lock_file_status': 'locked',
+            'lock_action': 'lock',
+        })
+
+        status = pylok.lock(self.lock_dir, 'obj', lock_action='status')
+        self.assertEqual(status, {
+            'msg': 'x',
+            'lock_file_location': self.lock_file('obj'),
+            'lock_file_status': 'locked',
+            'lock_action': 'status',
+        })
+
+        unlocked = pylok.lock(self.lock_dir, 'obj', lock_data={'msg': 'x'}, lock_action='unlock')
+        self.assertEqual(unlocked, {
+            'msg': 'x',
+            'lock_file_location': None,
+            'lock_file_status': 'unlocked',
+            'lock_action': 'unlock',
+        })
+        self.assertEqual(os.listdir(self.lock_dir), [])
+
+
+class TestLockAction(LockTestCase):
+    def test_lock_action_member_is_accepted(self):
+        locked = pylok.lock(self.lock_dir, 'obj', lock_action=pylok.LockAction.LOCK)
+        status = pylok.lock(self.lock_dir, 'obj', lock_action=pylok.LockAction.STATUS)
+
+        self.assertEqual(locked['lock_action'], 'lock')
+        self.assertEqual(status['lock_action'], 'status')
+        self.assertEqual(status['lock_file_status'], 'locked')
+
+    def test_unknown_action_is_rejected_before_touching_the_directory(self):
+        lock_dir = os.path.join(self.lock_dir, 'not-created')
+
+        with self.assertRaises(pylok.LockActionError) as raised:
+            pylok.lock(lock_dir, 'obj', lock_action='relock')
+
+        self.assertIsInstance(raised.exception.__cause__, ValueError)
+        self.assertFalse(os.path.exists(lock_dir))
+
+
+class TestUnlock(LockTestCase):
+    def test_unlock_missing_lock_raises(self):
+        with self.assertRaises(pylok.LockFileNotPresentForRemoval):
+            pylok.lock(self.lock_dir, 'obj', lock_action='unlock')
+
+    def test_unlock_missing_lock_with_ensure_lock_state_raises(self):
+        with self.assertRaises(pylok.LockFileNotPresentForRemoval):
+            pylok.lock(self.lock_dir, 'obj', lock_action='unlock', ensure_lock_state=True)
+
+    def test_removal_error_is_still_a_not_present_error(self):
+        with self.assertRaises(pylok.LockFileNotPresentError):
+            pylok.lock(self.lock_dir, 'obj', lock_action='unlock')
+
+
+class TestLockData(LockTestCase):
+    def test_callers_dict_is_not_mutated(self):
+        pylok.lock(self.lock_dir, 'obj', lock_data={'owner': 'A'}, lock_action='lock')
+        lock_data = {'msg': 'x'}
+
+        for lock_action in ('status', 'unlock', 'lock'):
+            result = pylok.lock(self.lock_dir, 'obj', lock_data=lock_data, lock_action=lock_action)
+            self.assertIsNot(result, lock_data)
+            self.assertEqual(lock_data, {'msg': 'x'})
+
+    def test_results_do_not_leak_between_calls(self):
+        pylok.lock(self.lock_dir, 'a', lock_data={'owner': 'A'}, lock_action='lock')
+
+        self.assertEqual(pylok.lock(self.lock_dir, 'a')['owner'], 'A')
+        self.assertNotIn('owner', pylok.lock(self.lock_dir, 'b'))
+
+
+class TestLockFilePayload(LockTestCase):
+    def test_lock_data_round_trips(self):
+        pylok.lock(self.lock_dir, 'obj', lock_data={'msg': 'x', 'data': {'status': 'MAINT'}}, lock_action='lock')
+
+        status = pylok.lock(self.lock_dir, 'obj', lock_action='status')
+        self.assertEqual(status['msg'], 'x')
+        self.assertEqual(status['data'], {'status': 'MAINT'})
+        with open(self.lock_file('obj')) as locker:
+            self.assertEqual(json.load(locker)['msg'], 'x')
+
+    def test_datetime_is_stored_as_iso_string(self):
+        when = datetime.datetime(2019, 12, 19, 9, 26, 3, 478039)
+        pylok.lock(self.lock_dir, 'obj', lock_data={'datetime': when, 'expire': when.date()}, lock_action='lock')
+
+        status = pylok.lock(self.lock_dir, 'obj', lock_action='status')
+        self.assertEqual(status['datetime'], '2019-12-19T09:26:03.478039')
+        self.assertEqual(status['expire'], '2019-12-19')
+
+    def test_other_non_json_values_are_rejected(self):
+        with self.assertRaises(TypeError):
+            pylok.lock(self.lock_dir, 'obj', lock_data={'hosts': {'a', 'b'}}, lock_action='lock')
+        self.assertFalse(os.path.lexists(self.lock_file('obj')))
+
+    def test_legacy_yaml_lock_file_is_read(self):
+        with open(self.lock_file('obj'), 'w') as locker:
+            locker.write('msg: legacy\nlock_file_status: locked\n')
+
+        status = pylok.lock(self.lock_dir, 'obj', lock_action='status')
+        self.assertEqual(status['msg'], 'legacy')
+        self.assertEqual(status['lock_file_status'], 'locked')
+
+    def test_empty_lock_file_is_read(self):
+        open(self.lock_file('obj'), 'w').close()
+
+        self.assertIsNone(pylok.read_lock_file(self.lock_file('obj')))
+
+
+    def test_short_writes_are_completed(self):
+        real_write = os.write
+
+        def short_write(fd, data):
+            return real_write(fd, bytes(data[:3]))
+
+        with mock.patch.object(pylok.os, 'write', side_effect=short_write):
+            pylok.lock(self.lock_dir, 'obj', lock_data={'msg': 'a longer payload'}, lock_action='lock')
+
+        self.assertEqual(pylok.read_lock_file(self.lock_file('obj'))['msg'], 'a longer payload')
+
+    def test_failed_exclusive_write_leaves_no_lock(self):
+        with mock.patch.object(pylok.os, 'write', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                pylok.lock(self.lock_dir, 'obj', lock_action='lock', ensure_unlock_state=True)
+
+        self.assertEqual(os.listdir(self.lock_dir), [])
+
+
+class TestLockFilePath(LockTestCase):
+    def test_lock_dir_with_or_without_trailing_slash(self):
+        with_slash = pylok.lock(self.lock_dir + os.sep, 'a', lock_action='lock')
+        without_slash = pylok.lock(self.lock_dir, 'b', lock_action='lock')
+
+        self.assertEqual(with_slash['lock_file_location'], self.lock_file('a'))
+        self.assertEqual(without_slash['lock_file_location'], self.lock_file('b'))
+        self.assertEqual(sorted(os.listdir(self.lock_dir)), ['a.lock', 'b.lock'])
+
+    def test_lock_object_with_path_separator_is_rejected(self):
+        outside = os.path.join(self.lock_dir, 'outside')
+        for lock_object in (outside, os.path.join('..', 'obj'), os.path.join('sub', 'obj')):
+            with self.assertRaises(pylok.LockObjectError):
+                pylok.lock(self.lock_dir, lock_object, lock_action='lock')
+
+        self.assertEqual(os.listdir(self.lock_dir), [])
+
+
+class TestIsLocked(LockTestCase):
+    def test_lock_file_is_locked(self):
+        pylok.lock(self.lock_dir, 'obj', lock_action='lock')
+
+        self.assertTrue(pylok.is_locked(self.lock_file('obj')))
+
+    def test_directory_is_not_a_lock(self):
+        os.mkdir(self.lock_file('obj'))
+
+        self.assertFalse(pylok.is_locked(self.lock_file('obj')))
+        self.assertFalse(pylok.is_locked(self.lock_file('obj'), lock_ttl=60))
+        status = pylok.lock(self.lock_dir, 'obj', lock_action='status')
+        self.assertEqual(status['lock_file_status'], 'unlocked')
+
+    def test_dangling_symlink_is_not_a_lock(self):
+        os.symlink(os.path.join(self.lock_dir, 'missing'), self.lock_file('obj'))
+
+        self.assertFalse(pylok.is_locked(self.lock_file('obj')))
+        status = pylok.lock(self.lock_dir, 'obj', lock_action='status')
+        self.assertEqual(status['lock_file_status'], 'unlocked')
+
+    def test_symlink_to_lock_file_is_locked(self):
+        pylok.lock(self.lock_dir, 'target', lock_action='lock')
+        os.symlink(self.lock_file('target'), self.lock_file('obj'))
+
+        self.assertTrue(pylok.is_locked(self.lock_file('obj')))
+
+
+class TestLockTtl(LockTestCase):
+    def test_fresh_lock_is_held(self):
+        pylok.lock(self.lock_dir, 'obj', lock_action='lock', lock_ttl=60)
+
+        status = pylok.lock(self.lock_dir, 'obj', lock_action='status', lock_ttl=60)
+        self.assertEqual(status['lock_file_status'], 'locked')
+
+    def test_expired_lock_is_unlocked_and_removed(self):
+        pylok.lock(self.lock_dir, 'obj', lock_action='lock', lock_ttl=60)
+        self.age_lock('obj', 120)
+
+        status = pylok.lock(self.lock_dir, 'obj', lock_action='status', lock_ttl=60)
+        self.assertEqual(status['lock_file_status'], 'unlocked')
+        self.assertEqual(os.listdir(self.lock_dir), [])
+
+    def test_expired_lock_can_be_retaken_exclusively(self):
+        pylok.lock(self.lock_dir, 'obj', lock_data={'owner': 'A'}, lock_action='lock', lock_ttl=60)
+        self.age_lock('obj', 120)
+
+        pylok.lock(self.lock_dir, 'obj', lock_data={'owner': 'B'}, lock_action='lock',
+                   ensure_unlock_state=True, lock_ttl=60)
+        self.assertEqual(pylok.read_lock_file(self.lock_file('obj'))['owner'], 'B')
+
+    def test_live_lock_blocks_exclusive_lock(self):
+        pylok.lock(self.lock_dir, 'obj', lock_action='lock', lock_ttl=60)
+
+        with self.assertRaises(pylok.LockFilePresentError):
+            pylok.lock(self.lock_dir, 'obj', lock_action='lock', ensure_unlock_state=True, lock_ttl=60)
+
+    def test_break_does_not_remove_a_lock_retaken_meanwhile(self):
+        pylok.lock(self.lock_dir, 'obj', lock_data={'owner': 'old'}, lock_action='lock', lock_ttl=60)
+        self.age_lock('obj', 120)
+        lock_file = self.lock_file('obj')
+        real_lstat = os.lstat
+        raced = []
+
+        def lstat_then_race(path, *args, **kwargs):
+            result = real_lstat(path, *args, **kwargs)
+            if path == lock_file and not raced:
+                # B breaks the stale lock and takes it right after A judged it expired
+                raced.append(True)
+                os.remove(lock_file)
+                pylok.write_to_lock_file(lock_file, lock_data={'owner': 'B'}, exclusive=True)
+            return result
+
+        with mock.patch.object(pylok.os, 'lstat', side_effect=lstat_then_race):
+            with self.assertRaises(pylok.LockFilePresentError):
+                pylok.lock(self.lock_dir, 'obj', lock_data={'owner': 'A'}, lock_action='lock',
+                           ensure_unlock_state=True, lock_ttl=60)
+
+        self.assertEqual(pylok.read_lock_file(lock_file)['owner'], 'B')
+        self.assertEqual(os.listdir(self.lock_dir), ['obj.lock'])
+
+    def race_break(self, link_side_effect):
+        # B re-takes the lock right after A judged it expired, then A's os.link put-back is replaced
+        pylok.lock(self.lock_dir, 'obj', lock_data={'owner': 'old'}, lock_action='lock', lock_ttl=60)
+        self.age_lock('obj', 120)
+        lock_file = self.lock_file('obj')
+        real_lstat = os.lstat
+        raced = []
+
+        def lstat_then_race(path, *args, **kwargs):
+            result = real_lstat(path, *args, **kwargs)
+            if path == lock_file and not raced:
+                raced.append(True)
+                os.remove(lock_file)
+                pylok.write_to_lock_file(lock_file, lock_data={'owner': 'B'}, exclusive=True)
+            return result
+
+        with mock.patch.object(pylok.os, 'lstat', side_effect=lstat_then_race), \
+                mock.patch.object(pylok.os, 'link', side_effect=link_side_effect):
+            return pylok.is_locked(lock_file, lock_ttl=60)
+
+    def test_break_without_hard_links_puts_lock_back(self):
+        self.assertTrue(self.race_break(OSError(errno.EPERM, 'no hard links')))
+
+        self.assertEqual(pylok.read_lock_file(self.lock_file('obj'))['owner'], 'B')
+        self.assertEqual(os.listdir(self.lock_dir), ['obj.lock'])
+
+    def test_break_without_hard_links_never_replaces_a_newer_lock(self):
+        def newer_lock_then_fail(src, dst):
+            pylok.write_to_lock_file(dst, lock_data={'owner': 'C'}, exclusive=True)
+            raise OSError(errno.EXDEV, 'no hard links')
+
+        self.assertTrue(self.race_break(newer_lock_then_fail))
+
+        self.assertEqual(pylok.read_lock_file(self.lock_file('obj'))['owner'], 'C')
+        self.assertEqual(os.listdir(self.lock_dir), ['obj.lock'])
+
+    def test_break_does_not_hide_unrelated_link_errors(self):
+        with self.assertRaises(PermissionError):
+            self.race_break(PermissionError(errno.EACCES, 'denied'))
+
+    def test_refresh_extends_lock(self):
+        pylok.lock(self.lock_dir, 'obj', lock_action='lock', lock_ttl=60)
+        self.age_lock('obj', 50)
+
+        pylok.refresh_lock(self.lock_dir, 'obj', lock_ttl=60)
+        self.assertTrue(pylok.is_locked(self.lock_file('obj'), lock_ttl=20))
+
+    def test_refresh_refuses_expired_lock(self):
+        pylok.lock(self.lock_dir, 'obj', lock_action='lock', lock_ttl=60)
+        self.age_lock('obj', 120)
+
+        with self.assertRaises(pylok.LockFileNotPresentError):
+            pylok.refresh_lock(self.lock_dir, 'obj', lock_ttl=60)
+        self.assertFalse(os.path.lexists(self.lock_file('obj')))
+
+
+
+class TestStatusCache(LockTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(pylok, 'STATUS_CACHE_TTL', 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(pylok._status_cache.clear)
+
+    def test_cached_answer_is_reused(self):
+        pylok.lock(self.lock_dir, 'obj', lock_action='lock')
+        self.assertTrue(pylok.is_locked(self.lock_file('obj')))
+
+        with mock.patch.object(pylok.os.path, 'isfile') as isfile:
+            self.assertTrue(pylok.is_locked(self.lock_file('obj')))
+        isfile.assert_not_called()
+
+    def test_status_of_lock_removed_elsewhere_is_unlocked(self):
+        pylok.lock(self.lock_dir, 'obj', lock_action='lock')
+        self.assertTrue(pylok.is_locked(self.lock_file('obj')))
+        os.remove(self.lock_file('obj'))
+
+        status = pylok.lock(self.lock_dir, 'obj', lock_action='status')
+        self.assertEqual(status['lock_file_status'], 'unlocked')
+        self.assertIsNone(status['lock_file_location'])
+        self.assertFalse(pylok.is_locked(self.lock_file('obj')))
+
+    def test_cache_is_bounded(self):
+        with mock.patch.object(pylok, '_STATUS_CACHE_SIZE', 3):
+            for i in range(10):
+                pylok.is_locked(self.lock_file(i))
+
+        self.assertEqual(list(pylok._status_cache), [self.lock_file(i) for i in (7, 8, 9)])
+
+
+    def test_concurrent_eviction(self):
+        errors = []
+
+        def probe(offset):
+            try:
+                for i in range(2000):
+                    pylok.is_locked(self.lock_file(offset + i))
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch.object(pylok, '_STATUS_CACHE_SIZE', 8):
+            threads = [threading.Thread(target=probe, args=(n * 10000,)) for n in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(pylok._status_cache), 8)
+
+
+class TestLockMany(LockTestCase):
+    def test_locks_every_object(self):
+        results = pylok.lock_many(self.lock_dir, ['m1', 'm2'], lock_data={'msg': 'x'})
+
+        self.assertEqual(sorted(results), ['m1', 'm2'])
+        self.assertEqual(sorted(os.listdir(self.lock_dir)), ['m1.lock', 'm2.lock'])
+
+    def test_failed_lock_undoes_locks_already_taken(self):
+        pylok.lock(self.lock_dir, 'm3', lock_data={'owner': 'other'}, lock_action='lock')
+
+        with self.assertRaises(pylok.LockFilePresentError) as raised:
+            pylok.lock_many(self.lock_dir, ['m1', 'm2', 'm3'], ensure_unlock_state=True)
+
+        self.assertEqual(os.listdir(self.lock_dir), ['m3.lock'])
+        self.assertEqual(pylok.read_lock_file(self.lock_file('m3'))['owner'], 'other')
+        self.assertEqual(sorted(raised.exception.lock_results), ['m1', 'm2'])
+        self.assertEqual(raised.exception.lock_results['m1']['lock_file_status'], 'unlocked')
+
+    def test_failed_lock_keeps_locks_it_did_not_create(self):
+        pylok.lock(self.lock_dir, 'm1', lock_data={'owner': 'other'}, lock_action='lock')
+        write_to_lock_file = pylok.write_to_lock_file
+
+        def fail_on_m2(lock_file, **kwargs):
+            if lock_file == self.lock_file('m2'):
+                raise OSError('disk full')
+            return write_to_lock_file(lock_file, **kwargs)
+
+        with mock.patch.object(pylok, 'write_to_lock_file', side_effect=fail_on_m2):
+            with self.assertRaises(OSError) as raised:
+                pylok.lock_many(self.lock_dir, ['m1', 'm2'], lock_data={'owner': 'me'})
+
+        self.assertEqual(os.listdir(self.lock_dir), ['m1.lock'])
+        self.assertEqual(raised.exception.lock_results['m1']['lock_file_status'], 'locked')
+
+    def test_failed_unlock_reports_completed_objects(self):
+        pylok.lock(self.lock_dir, 'm1', lock_action='lock')
+
+        with self.assertRaises(pylok.LockFileNotPresentError) as raised:
+            pylok.lock_many(self.lock_dir, ['m1', 'm2'], lock_action='unlock')
+
+        self.assertEqual(raised.exception.lock_results['m1']['lock_file_status'], 'unlocked')
+
+
+if __name__ == '__main__':
+    unittest.main()